@@ -2,7 +2,7 @@ import streamlit as st
 from google import genai
 from google.genai import types
 from google.genai import errors
-import pandas as pd
+import csv
 import io
 from datetime import datetime
 import time
@@ -21,7 +21,13 @@ SYSTEM_PROMPT = """
 4. 마지막에는 반드시 다음 메시지를 출력하세요: "오늘의 당신에게 맞는 상품을 추천해드릴 수 있어요."라고 정중히 안내하세요.
 """
 RESTART_MESSAGE = "❗️ API 요청 오류(429 등)가 발생하여 이전 6턴의 대화만 유지하고 채팅 세션을 재시작합니다."
+
+# System instruction configuration (constant, so built once at import time)
+SYSTEM_CONFIG = types.GenerateContentConfig(system_instruction=SYSTEM_PROMPT)
 MAX_HISTORY_TURN = 6 # Max turns (user/model pair) to keep upon 429 restart
+FLUSH_INTERVAL_SEC = 0.025 # Min interval between streaming UI flushes
+FLUSH_MIN_CHARS = 64 # Flush early once this many chars are pending
+DISPLAY_WINDOW = 40 # Max messages re-rendered per rerun; older turns live in the CSV buffer
 
 # Available models list (excluding -exp)
 AVAILABLE_MODELS = [
@@ -30,6 +36,10 @@ AVAILABLE_MODELS = [
     "gemini-2.0-pro",
     "gemini-2.5-pro",
 ]
+DEFAULT_MODEL_INDEX = AVAILABLE_MODELS.index(DEFAULT_MODEL)
+
+# Map Streamlit role to Gemini role
+ROLE_MAP = {"user": "user", "assistant": "model"}
 
 st.set_page_config(page_title=APP_TITLE, layout="wide")
 st.title(APP_TITLE)
@@ -48,36 +58,53 @@ def get_api_key():
         
     return api_key
 
-def initialize_client_and_chat(api_key, model_name, system_prompt, history_to_restore=None):
+LOG_FIELDNAMES = ["Timestamp", "Role", "Content", "Model"]
+
+def _csv_header_bytes():
+    buf = io.StringIO()
+    csv.DictWriter(buf, fieldnames=LOG_FIELDNAMES).writeheader()
+    return buf.getvalue().encode('utf-8')
+
+CSV_HEADER_BYTES = _csv_header_bytes()
+
+def append_log(entry):
+    """Record one log entry and grow the CSV buffer by its serialized row."""
+    st.session_state.history_log.append(entry)
+    buf = io.StringIO()
+    csv.DictWriter(buf, fieldnames=LOG_FIELDNAMES).writerow(entry)
+    st.session_state.csv_buffer += buf.getvalue().encode('utf-8')
+    # The CSV buffer holds the full log; the list only needs the 429-restart window
+    del st.session_state.history_log[:-(MAX_HISTORY_TURN * 2)]
+
+@st.cache_resource
+def get_genai_client(api_key):
+    """Return a cached Gemini client so the HTTP pool survives reruns."""
+    return genai.Client(api_key=api_key)
+
+def initialize_client_and_chat(api_key, model_name, history_to_restore=None):
     """Initializes Gemini client and a new Chat session."""
     try:
-        client = genai.Client(api_key=api_key)
-        
-        # System instruction configuration
-        config = types.GenerateContentConfig(
-            system_instruction=system_prompt
-        )
-        
-        # Start new Chat session
-        chat = client.chats.create(model=model_name, config=config)
+        client = get_genai_client(api_key)
+
+        # Start new Chat session; st.session_state.gemini_chat is already the
+        # per-session O(1) lookup, so the chat itself is not cached globally
+        chat = client.chats.create(model=model_name, config=SYSTEM_CONFIG)
         st.session_state.gemini_chat = chat
         st.session_state.model_name = model_name
         
         # Restore history if provided (used for 429 restart)
         if history_to_restore:
-            # Reconstruct Chat history for the new session
-            for msg in history_to_restore:
-                # Map Streamlit role to Gemini role
-                role_map = {"user": "user", "assistant": "model"}
-                chat.history.append(
-                    types.Content(
-                        role=role_map[msg["role"]],
-                        parts=[types.Part.from_text(msg["content"])]
-                    )
+            # Reconstruct Chat history for the new session in one extend
+            chat.history.extend(
+                types.Content(
+                    role=ROLE_MAP[msg["role"]],
+                    parts=[types.Part.from_text(msg["content"])]
                 )
+                for msg in history_to_restore
+            )
             st.session_state.messages = history_to_restore
             st.session_state.messages.append({"role": "assistant", "content": RESTART_MESSAGE})
-            st.session_state.history_log.append({
+            append_log({
                 "Timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                 "Role": "assistant",
                 "Content": RESTART_MESSAGE,
@@ -87,9 +114,12 @@ def initialize_client_and_chat(api_key, model_name, system_prompt, history_to_re
         else:
             st.session_state.messages = []
             st.session_state.history_log = [] # Full conversation log for CSV
-            
-        st.rerun()
-        
+            st.session_state.csv_buffer = bytearray(CSV_HEADER_BYTES)
+
+        # Callers decide when to rerun; an unconditional rerun here aborted the
+        # streaming handler mid-script on the 429 restart path.
+        return True
+
     except Exception as e:
         st.error(f"Gemini 클라이언트/채팅 초기화 오류: {e}")
         st.stop()
@@ -99,6 +129,7 @@ def initialize_client_and_chat(api_key, model_name, system_prompt, history_to_re
 if 'gemini_chat' not in st.session_state:
     st.session_state.messages = []
     st.session_state.history_log = []
+    st.session_state.csv_buffer = bytearray(CSV_HEADER_BYTES)
     st.session_state.model_name = DEFAULT_MODEL
     
 # --- Sidebar and UI Configuration ---
@@ -110,7 +141,7 @@ with st.sidebar:
     selected_model = st.selectbox(
         "사용할 모델 선택", 
         AVAILABLE_MODELS,
-        index=AVAILABLE_MODELS.index(DEFAULT_MODEL),
+        index=DEFAULT_MODEL_INDEX,
         key="model_select_key"
     )
     
@@ -119,7 +150,8 @@ with st.sidebar:
     
     # Session Reset Button
     if st.button("💬 대화 초기화 및 모델 적용", help="대화 기록을 지우고 새 모델로 시작합니다."):
-        initialize_client_and_chat(api_key, selected_model, SYSTEM_PROMPT)
+        if initialize_client_and_chat(api_key, selected_model):
+            st.rerun()
 
     st.markdown("---")
     st.subheader("로그 기록 옵션")
@@ -128,15 +160,17 @@ with st.sidebar:
     if 'auto_log' not in st.session_state:
         st.session_state.auto_log = False
     st.session_state.auto_log = st.checkbox("CSV 자동 기록 (대화마다 기록)", st.session_state.auto_log)
+
+    # Streaming Option (off = single render, lower UI overhead)
+    if 'stream_mode' not in st.session_state:
+        st.session_state.stream_mode = True
+    st.session_state.stream_mode = st.checkbox("스트리밍 출력 (토큰 단위 표시)", st.session_state.stream_mode)
     
     # Log Download
     if st.session_state.history_log:
-        log_df = pd.DataFrame(st.session_state.history_log)
-        # Convert to CSV and ensure proper encoding
-        csv_data = log_df.to_csv(index=False).encode('utf-8')
         st.download_button(
             label="⬇️ 대화 로그 CSV 다운로드",
-            data=csv_data,
+            data=bytes(st.session_state.csv_buffer),
             file_name=f"gemini_chat_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
             mime="text/csv",
         )
@@ -146,27 +180,39 @@ with st.sidebar:
 # Client and Chat session check (Re-initialize if model changed or first run)
 if 'gemini_chat' not in st.session_state or st.session_state.model_name != selected_model:
     if api_key:
-        initialize_client_and_chat(api_key, selected_model, SYSTEM_PROMPT)
+        if initialize_client_and_chat(api_key, selected_model):
+            st.rerun()
 
 # Display Model and Session Info
+_msgs = st.session_state.messages
+_n = len(_msgs)
 st.sidebar.markdown("---")
 st.sidebar.markdown(f"**현재 모델:** `{st.session_state.model_name}`")
-st.sidebar.markdown(f"**총 턴 수:** {len(st.session_state.messages)//2} (메시지 {len(st.session_state.messages)}개)")
+st.sidebar.markdown(f"**총 턴 수:** {_n//2} (메시지 {_n}개)")
 
 
-# --- Display Conversation History ---
-for message in st.session_state.messages:
+# --- Display Conversation History (bounded so rerun cost stays constant) ---
+# Streamlit rebuilds the frontend on every script run, so the transcript must be
+# replayed in full each time; tracking a "already rendered" count across runs
+# would blank older messages. The window slice keeps this replay O(1), and since
+# streamed turns no longer force a rerun, most turns skip this loop entirely.
+for message in _msgs[-DISPLAY_WINDOW:]:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
 # --- User Input Processing ---
 if prompt := st.chat_input("오늘의 날씨와 일정을 말씀해 주세요 (예: 오늘 최고 25도, 최저 10도, 친구와 카페에 갑니다, 여성, 30대)"):
     # 1. Record and Display User Message
-    st.session_state.messages.append({"role": "user", "content": prompt})
-    
+    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    # Bind session_state lists to locals; repeated session_state lookups go
+    # through its descriptor protocol and are not free on the per-message path
+    msgs = st.session_state.messages
+    log = st.session_state.history_log
+    msgs.append({"role": "user", "content": prompt})
+
     # Log User Message
-    st.session_state.history_log.append({
-        "Timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    append_log({
+        "Timestamp": now_str,
         "Role": "user",
         "Content": prompt,
         "Model": st.session_state.model_name
@@ -179,27 +225,66 @@ if prompt := st.chat_input("오늘의 날씨와 일정을 말씀해 주세요 (
     with st.chat_message("assistant"):
         message_placeholder = st.empty()
         full_response = ""
-        
+
+        # Proactively bound the context shipped to Gemini instead of waiting for a
+        # 429: keep only the most recent turns, and trim the display list to match.
+        chat = st.session_state.gemini_chat
+        chat.history[:] = chat.history[-(MAX_HISTORY_TURN * 2):]
+        del msgs[:-DISPLAY_WINDOW]
+
         try:
-            # Use send_message for continuous conversation
-            response = st.session_state.gemini_chat.send_message(prompt, stream=True)
-            
-            # Stream the response
-            for chunk in response:
-                if chunk.text:
-                    full_response += chunk.text
-                    message_placeholder.markdown(full_response + "▌")
-            
-            message_placeholder.markdown(full_response)
-        
-        except genai.errors.ResourceExhaustedError: # Handle 429
+            # Most 429s are transient: retry the same send once with backoff
+            # (honoring Retry-After when the SDK exposes it) before falling back
+            # to the expensive full chat restart below.
+            for attempt in range(2):
+                try:
+                    if st.session_state.stream_mode:
+                        # Use send_message for continuous conversation
+                        response = chat.send_message(prompt, stream=True)
+
+                        # Stream the response (buffer chunks; join only when flushing to the UI).
+                        # Flushing on every chunk re-parses markdown and re-renders the DOM, so
+                        # throttle to ~25ms / 64 chars. The first chunk flushes immediately to
+                        # preserve perceived first-token latency.
+                        buffer = []
+                        joined_cache = ""
+                        last_flush = 0.0
+                        pending_len = 0
+                        for chunk in response:
+                            if chunk.text:
+                                buffer.append(chunk.text)
+                                pending_len += len(chunk.text)
+                                now = time.monotonic()
+                                if now - last_flush >= FLUSH_INTERVAL_SEC or pending_len >= FLUSH_MIN_CHARS:
+                                    joined_cache = "".join(buffer)
+                                    message_placeholder.markdown(joined_cache + "▌")
+                                    last_flush = now
+                                    pending_len = 0
+
+                        # Reuse the last join when no chunks arrived after the final flush
+                        full_response = joined_cache if not pending_len else "".join(buffer)
+                    else:
+                        # Non-streaming: one request, one render — skips all per-chunk UI work
+                        response = chat.send_message(prompt)
+                        full_response = response.text or ""
+
+                    message_placeholder.markdown(full_response)
+                    break
+
+                except genai.errors.ResourceExhaustedError as e:
+                    if attempt + 1 >= 2:
+                        raise
+                    time.sleep(getattr(e, "retry_after", None) or 2 ** attempt)
+
+        except genai.errors.ResourceExhaustedError: # Handle 429 after retry
             # Get the last MAX_HISTORY_TURN pairs
-            history_to_keep = st.session_state.messages[-(MAX_HISTORY_TURN * 2):]
-            log_to_keep = st.session_state.history_log[-(MAX_HISTORY_TURN * 2):]
+            history_to_keep = msgs[-(MAX_HISTORY_TURN * 2):]
+            log_to_keep = log[-(MAX_HISTORY_TURN * 2):]
 
-            # Re-initialize client/chat, restoring history
-            initialize_client_and_chat(api_key, st.session_state.model_name, SYSTEM_PROMPT, history_to_keep)
-            # Rerun will happen inside the helper function
+            # Re-initialize client/chat, restoring history, then rerun once the
+            # restart log entry has been written
+            initialize_client_and_chat(api_key, st.session_state.model_name, history_to_keep)
+            st.rerun()
             
         except Exception as e:
             full_response = f"죄송합니다. 오류가 발생했습니다: {e}"
@@ -207,15 +292,15 @@ if prompt := st.chat_input("오늘의 날씨와 일정을 말씀해 주세요 (
             
         # 3. Record Model Response
         if full_response and full_response != RESTART_MESSAGE:
-            st.session_state.messages.append({"role": "assistant", "content": full_response})
+            msgs.append({"role": "assistant", "content": full_response})
             
             # Log Assistant Message (if not a restart message)
             if st.session_state.auto_log:
-                st.session_state.history_log.append({
-                    "Timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                append_log({
+                    "Timestamp": now_str,
                     "Role": "assistant",
                     "Content": full_response,
                     "Model": st.session_state.model_name
                 })
-        
-    st.rerun() # Refresh to show updated chat
+    # No rerun needed: the streamed placeholder already shows the reply, and the
+    # next natural interaction replays history from st.session_state.messages.